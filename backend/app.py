@@ -3,8 +3,15 @@ from flask_cors import CORS
 import os
 import requests
 from dotenv import load_dotenv
-from pymongo import MongoClient
-from typing import List, Dict, Any
+from pymongo import MongoClient, UpdateOne
+from typing import List, Dict, Any, Optional
+from datetime import datetime, timezone
+import threading
+import time
+import numpy as np
+from recommendations import STATUS_WEIGHTS, RecommendationModel, build_genre_matrix, top_n
+from posters import PosterCache
+from urllib.parse import urlparse, parse_qs, quote
 
 # Load environment variables
 load_dotenv()
@@ -34,6 +41,48 @@ TMDB_BASE_URL = 'https://api.themoviedb.org/3'
 MAL_CLIENT_ID = os.getenv('MAL_CLIENT_ID')
 MAL_BASE_URL = 'https://api.myanimelist.net/v2'
 
+# Recommendations configuration
+# Every card we format is remembered in the catalog so the recommender knows each title's genres
+catalog_collection = db.catalog
+catalog_collection.create_index([
+    ("contentId", 1),
+    ("contentType", 1)
+], unique=True)
+# Precomputed top-N recommendations, one document per user
+recommendations_collection = db.recommendations
+recommendations_collection.create_index("userId", unique=True)
+# Precomputed "more like this", one document per catalog title
+similar_collection = db.similar_content
+similar_collection.create_index([
+    ("contentId", 1),
+    ("contentType", 1)
+], unique=True)
+
+RECOMMENDATIONS_TOP_N = int(os.getenv('RECOMMENDATIONS_TOP_N', 50))
+# How often the recommendations job rebuilds everything, and how often it picks up status changes in between
+RECOMMENDATIONS_REFRESH_SECONDS = int(os.getenv('RECOMMENDATIONS_REFRESH_SECONDS', 3600))
+RECOMMENDATIONS_POLL_SECONDS = int(os.getenv('RECOMMENDATIONS_POLL_SECONDS', 10))
+# Share of the score that comes from genre similarity; the rest comes from co-watching
+RECOMMENDATIONS_GENRE_WEIGHT = float(os.getenv('RECOMMENDATIONS_GENRE_WEIGHT', 0.6))
+
+# Poster proxy configuration
+POSTER_PROXY_ENABLED = os.getenv('POSTER_PROXY_ENABLED', 'false').lower() == 'true'
+# Public URL of this API used in proxied poster URLs, defaults to the host of the incoming request
+POSTER_PROXY_BASE_URL = os.getenv('POSTER_PROXY_BASE_URL', '')
+POSTER_CACHE_DIR = os.getenv('POSTER_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'poster_cache'))
+POSTER_CACHE_MAX_BYTES = int(os.getenv('POSTER_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+# Smallest cache that still holds a useful number of posters
+POSTER_CACHE_MIN_BYTES = 16 * 1024 * 1024
+if POSTER_PROXY_ENABLED and POSTER_CACHE_MAX_BYTES < POSTER_CACHE_MIN_BYTES:
+    raise ValueError(f"POSTER_CACHE_MAX_BYTES must be at least {POSTER_CACHE_MIN_BYTES}")
+# Only images from the providers we already use can be proxied
+POSTER_ALLOWED_HOSTS = {'image.tmdb.org', 'cdn.myanimelist.net', 'api-cdn.myanimelist.net', 'static.tvmaze.com'}
+# Thumbnail widths in pixels; height follows the poster's aspect ratio
+POSTER_SIZES = {
+    'small': 185,
+    'medium': 342
+}
+
 @app.route('/')
 def home():
     return jsonify({"message": "Welcome to the API"})
@@ -57,7 +106,7 @@ def search():
             formatted_shows.append({
                 "id": str(show_data.get('id', '')),
                 "title": show_data.get('name', ''),
-                "posterUrl": show_data.get('image', {}).get('medium', '/placeholder.svg?height=450&width=300'),
+                "posterUrl": poster_url(show_data.get('image', {}).get('medium', '/placeholder.svg?height=450&width=300')),
                 "rating": show_data.get('rating', {}).get('average', 0) or 0,
                 "year": show_data.get('premiered', '')[:4] if show_data.get('premiered') else '',
                 "summary": show_data.get('summary', ''),
@@ -101,7 +150,7 @@ def get_show(show_id):
         formatted_show = {
             "id": str(show_data.get('id', '')),
             "title": show_data.get('name', ''),
-            "posterUrl": show_data.get('image', {}).get('medium', '/placeholder.svg?height=450&width=300'),
+            "posterUrl": poster_url(show_data.get('image', {}).get('medium', '/placeholder.svg?height=450&width=300')),
             "rating": show_data.get('rating', {}).get('average', 0) or 0,
             "year": show_data.get('premiered', '')[:4] if show_data.get('premiered') else '',
             "summary": show_data.get('summary', ''),
@@ -187,6 +236,7 @@ def update_watch_status():
                     "contentId": content_id,
                     "contentType": content_type
                 })
+                mark_recommendations_stale(user_id)
                 return jsonify({"message": "Status removed successfully"})
             else:
                 # Update the status
@@ -194,6 +244,7 @@ def update_watch_status():
                     {"userId": user_id, "contentId": content_id, "contentType": content_type},
                     {"$set": {"status": status}}
                 )
+                mark_recommendations_stale(user_id)
                 return jsonify({"message": "Status updated successfully"})
         else:
             # Create new status
@@ -204,6 +255,7 @@ def update_watch_status():
                     "contentType": content_type,
                     "status": status
                 })
+                mark_recommendations_stale(user_id)
                 return jsonify({"message": "Status created successfully"})
             else:
                 return jsonify({"message": "No action needed"})
@@ -284,6 +336,7 @@ def user_watch_status(user_id, content_type, content_id):
                     "contentType": content_type
                 })
                 if result.deleted_count > 0:
+                    mark_recommendations_stale(user_id)
                     return jsonify({"message": "Status removed successfully"})
                 return jsonify({"message": "No status to remove"})
             else:
@@ -305,6 +358,7 @@ def user_watch_status(user_id, content_type, content_id):
                     },
                     upsert=True
                 )
+                mark_recommendations_stale(user_id)
                 return jsonify({"message": "Status updated successfully"})
         except Exception as e:
             print(f"Error updating watch status: {str(e)}")
@@ -391,7 +445,7 @@ def get_content_by_status(user_id, content_type):
                     content_list.append({
                         "id": str(data['id']),
                         "title": data['title'],
-                        "posterUrl": data['poster_path'] and f"https://image.tmdb.org/t/p/w500{data['poster_path']}" or "/placeholder.svg?height=450&width=300",
+                        "posterUrl": poster_url(data['poster_path'] and f"https://image.tmdb.org/t/p/w500{data['poster_path']}" or "/placeholder.svg?height=450&width=300"),
                         "rating": data['vote_average'] or 0,
                         "year": data['release_date'][:4] if data.get('release_date') else "",
                         "summary": data.get('overview', ''),
@@ -410,7 +464,7 @@ def get_content_by_status(user_id, content_type):
                     content_list.append({
                         "id": str(data['id']),
                         "title": data['name'],
-                        "posterUrl": data['poster_path'] and f"https://image.tmdb.org/t/p/w500{data['poster_path']}" or "/placeholder.svg?height=450&width=300",
+                        "posterUrl": poster_url(data['poster_path'] and f"https://image.tmdb.org/t/p/w500{data['poster_path']}" or "/placeholder.svg?height=450&width=300"),
                         "rating": data['vote_average'] or 0,
                         "year": data['first_air_date'][:4] if data.get('first_air_date') else "",
                         "summary": data.get('overview', ''),
@@ -423,6 +477,7 @@ def get_content_by_status(user_id, content_type):
                 continue
         
         print(f"Returning {len(content_list)} {content_type}s")
+        remember_cards(content_list)
         return jsonify({f"{content_type}s": content_list})
     except Exception as e:
         print(f"Error in get_content_by_status: {str(e)}")
@@ -440,7 +495,7 @@ def get_tmdb_content(content_id: str, content_type: str) -> Dict[str, Any]:
         return {
             "id": str(data['id']),
             "title": data.get('title') or data.get('name'),
-            "posterUrl": data.get('poster_path') and f"https://image.tmdb.org/t/p/w500{data['poster_path']}" or "/placeholder.svg?height=450&width=300",
+            "posterUrl": poster_url(data.get('poster_path') and f"https://image.tmdb.org/t/p/w500{data['poster_path']}" or "/placeholder.svg?height=450&width=300"),
             "rating": data.get('vote_average', 0),
             "year": (data.get('release_date') or data.get('first_air_date', ''))[:4],
             "summary": data.get('overview', ''),
@@ -526,7 +581,7 @@ def get_all_content(user_id):
                             anime_content = {
                                 "id": str(anime_data['id']),
                                 "title": anime_data['title'],
-                                "posterUrl": anime_data.get('main_picture', {}).get('medium', '/placeholder.svg?height=450&width=300'),
+                                "posterUrl": poster_url(anime_data.get('main_picture', {}).get('medium', '/placeholder.svg?height=450&width=300')),
                                 "rating": anime_data.get('mean', 0),
                                 "year": anime_data.get('start_date', '')[:4] if anime_data.get('start_date') else '',
                                 "summary": anime_data.get('synopsis', ''),
@@ -562,6 +617,8 @@ def get_all_content(user_id):
                         print(f"Unexpected error fetching {content_type} {content_id}: {str(e)}")
                         continue
                 
+                remember_cards(content_list)
+                
                 # Handle plural form correctly
                 if content_type == 'anime':
                     response['anime'][status] = content_list
@@ -598,7 +655,7 @@ def get_popular_anime():
             formatted_anime.append({
                 "id": str(anime_data.get('id', '')),
                 "title": anime_data.get('title', ''),
-                "posterUrl": anime_data.get('main_picture', {}).get('medium', '/placeholder.svg?height=450&width=300'),
+                "posterUrl": poster_url(anime_data.get('main_picture', {}).get('medium', '/placeholder.svg?height=450&width=300')),
                 "rating": anime_data.get('mean', 0) or 0,
                 "year": anime_data.get('start_date', '')[:4] if anime_data.get('start_date') else '',
                 "summary": anime_data.get('synopsis', ''),
@@ -608,6 +665,7 @@ def get_popular_anime():
                 "episodes": anime_data.get('num_episodes', 0)
             })
         
+        remember_cards(formatted_anime)
         return jsonify({"results": formatted_anime})
     except requests.exceptions.RequestException as e:
         return jsonify({"error": f"Error fetching data from MyAnimeList API: {str(e)}"}), 500
@@ -637,7 +695,7 @@ def search_anime():
             formatted_anime.append({
                 "id": str(anime_data.get('id', '')),
                 "title": anime_data.get('title', ''),
-                "posterUrl": anime_data.get('main_picture', {}).get('medium', '/placeholder.svg?height=450&width=300'),
+                "posterUrl": poster_url(anime_data.get('main_picture', {}).get('medium', '/placeholder.svg?height=450&width=300')),
                 "rating": anime_data.get('mean', 0) or 0,
                 "year": anime_data.get('start_date', '')[:4] if anime_data.get('start_date') else '',
                 "summary": anime_data.get('synopsis', ''),
@@ -647,6 +705,7 @@ def search_anime():
                 "episodes": anime_data.get('num_episodes', 0)
             })
         
+        remember_cards(formatted_anime)
         return jsonify({"results": formatted_anime})
     except requests.exceptions.RequestException as e:
         return jsonify({"error": f"Error fetching data from MyAnimeList API: {str(e)}"}), 500
@@ -669,7 +728,7 @@ def get_anime_details(anime_id):
         formatted_anime = {
             "id": str(anime_data.get('id', '')),
             "title": anime_data.get('title', ''),
-            "posterUrl": anime_data.get('main_picture', {}).get('medium', '/placeholder.svg?height=450&width=300'),
+            "posterUrl": poster_url(anime_data.get('main_picture', {}).get('medium', '/placeholder.svg?height=450&width=300')),
             "rating": anime_data.get('mean', 0) or 0,
             "year": anime_data.get('start_date', '')[:4] if anime_data.get('start_date') else '',
             "summary": anime_data.get('synopsis', ''),
@@ -683,10 +742,275 @@ def get_anime_details(anime_id):
             "studios": [studio.get('name', '') for studio in anime_data.get('studios', [])]
         }
         
+        remember_cards([formatted_anime])
         return jsonify(formatted_anime)
     except requests.exceptions.RequestException as e:
         return jsonify({"error": f"Error fetching data from MyAnimeList API: {str(e)}"}), 500
 
+# Poster proxy
+
+def poster_url(source_url: Optional[str], size: str = 'medium') -> Optional[str]:
+    """Point a poster at the proxy when it is enabled, leaving placeholders and unknown hosts alone."""
+    if not POSTER_PROXY_ENABLED or not source_url or urlparse(source_url).hostname not in POSTER_ALLOWED_HOSTS:
+        return source_url
+    base_url = POSTER_PROXY_BASE_URL or request.url_root
+    return f"{base_url.rstrip('/')}/api/posters/{size}?url={quote(source_url, safe='')}"
+
+def source_poster_url(url: Optional[str]) -> Optional[str]:
+    """Undo poster_url so stored cards keep pointing at the original image."""
+    if url and '/api/posters/' in url:
+        return parse_qs(urlparse(url).query).get('url', [url])[0]
+    return url
+
+poster_cache = PosterCache(POSTER_CACHE_DIR, POSTER_CACHE_MAX_BYTES, POSTER_SIZES)
+
+@app.route('/api/posters/<size>', methods=['GET'])
+def get_poster(size):
+    if not POSTER_PROXY_ENABLED:
+        return jsonify({"error": "Poster proxy is disabled"}), 404
+
+    source_url = request.args.get('url', '')
+    if size not in POSTER_SIZES:
+        return jsonify({"error": f"size must be one of: {', '.join(POSTER_SIZES)}"}), 400
+    parsed = urlparse(source_url)
+    if parsed.scheme not in ('http', 'https') or parsed.hostname not in POSTER_ALLOWED_HOSTS:
+        return jsonify({"error": "url must point to a supported image host"}), 400
+
+    return poster_cache.response(source_url, size)
+
+# Recommendations
+
+def remember_cards(cards: List[Dict[str, Any]]) -> None:
+    """Store formatted cards in the catalog so they can be recommended later.
+
+    Only pass cards keyed by TMDB or MyAnimeList ids, the same ids watch statuses use.
+    TVmaze show ids would overwrite the TMDB show with the same number.
+    """
+    operations = []
+    for card in cards:
+        if not card or not card.get('id'):
+            continue
+        entry = {key: value for key, value in card.items() if key != 'seasons'}
+        # Keep the original poster so the proxy can be toggled without rewriting the catalog
+        entry['posterUrl'] = source_poster_url(entry.get('posterUrl'))
+        operations.append(UpdateOne(
+            {"contentId": card['id'], "contentType": card['type']},
+            {"$set": entry},
+            upsert=True
+        ))
+    if not operations:
+        return
+    try:
+        catalog_collection.bulk_write(operations, ordered=False)
+    except Exception as e:
+        print(f"Error updating catalog: {str(e)}")
+
+_recommendation_model: Optional[RecommendationModel] = None
+_recommendation_lock = threading.Lock()
+
+def build_recommendation_model() -> RecommendationModel:
+    """Load the catalog and all watch statuses into matrices."""
+    items = list(catalog_collection.find({}, {"_id": 0, "contentId": 0, "contentType": 0}))
+    item_index = {(item['type'], item['id']): i for i, item in enumerate(items)}
+
+    entries = watch_status_collection.find(
+        {"status": {"$in": list(STATUS_WEIGHTS)}},
+        {"_id": 0, "userId": 1, "contentId": 1, "contentType": 1, "status": 1}
+    )
+    user_ids, rows, cols, weights = [], [], [], []
+    user_index = {}
+    for entry in entries:
+        item = item_index.get((entry['contentType'], entry['contentId']))
+        if item is None:
+            continue
+        if entry['userId'] not in user_index:
+            user_index[entry['userId']] = len(user_ids)
+            user_ids.append(entry['userId'])
+        rows.append(user_index[entry['userId']])
+        cols.append(item)
+        weights.append(STATUS_WEIGHTS[entry['status']])
+    interactions = np.zeros((len(user_ids), len(items)), dtype=np.float32)
+    interactions[rows, cols] = weights
+
+    return RecommendationModel(items, build_genre_matrix(items), user_ids, interactions, RECOMMENDATIONS_GENRE_WEIGHT)
+
+def _save_recommendations(model: RecommendationModel, user_indexes: np.ndarray) -> Dict[str, List[Dict[str, Any]]]:
+    """Compute top-N for a block of users and write them to the recommendations table."""
+    if not model.items or len(user_indexes) == 0:
+        return {}
+    scores = model.score_users(user_indexes)
+    top = top_n(scores, RECOMMENDATIONS_TOP_N)
+    top_by_type = model.top_by_type(scores, RECOMMENDATIONS_TOP_N)
+    updated_at = datetime.now(timezone.utc)
+    results = {}
+    operations = []
+    for row, user_index in enumerate(user_indexes):
+        user_id = model.user_ids[user_index]
+        results[user_id] = model.cards(scores[row], top[row])
+        by_type = {
+            content_type: model.cards(scores[row], type_top[row])
+            for content_type, type_top in top_by_type.items()
+        }
+        operations.append(UpdateOne(
+            {"userId": user_id},
+            {"$set": {"items": results[user_id], "byType": by_type, "updatedAt": updated_at}},
+            upsert=True
+        ))
+    recommendations_collection.bulk_write(operations, ordered=False)
+    return results
+
+def _save_similar(model: RecommendationModel, item_indexes: np.ndarray) -> None:
+    """Compute "more like this" for a block of titles and write them to the similar content table."""
+    if len(item_indexes) == 0:
+        return
+    scores = model.score_similar(item_indexes)
+    top = top_n(scores, RECOMMENDATIONS_TOP_N)
+    updated_at = datetime.now(timezone.utc)
+    operations = []
+    for row, item_index in enumerate(item_indexes):
+        item = model.items[item_index]
+        operations.append(UpdateOne(
+            {"contentId": item['id'], "contentType": item['type']},
+            {"$set": {"items": model.cards(scores[row], top[row]), "updatedAt": updated_at}},
+            upsert=True
+        ))
+    similar_collection.bulk_write(operations, ordered=False)
+
+def _refresh_all_recommendations(block_size: int) -> RecommendationModel:
+    global _recommendation_model
+    start = time.time()
+    started_at = datetime.now(timezone.utc)
+    model = build_recommendation_model()
+    user_indexes = np.arange(len(model.user_ids))
+    for block_start in range(0, len(user_indexes), block_size):
+        _save_recommendations(model, user_indexes[block_start:block_start + block_size])
+    item_indexes = np.arange(len(model.items))
+    for block_start in range(0, len(item_indexes), block_size):
+        _save_similar(model, item_indexes[block_start:block_start + block_size])
+    # Users who no longer have any watch statuses weren't rewritten above
+    recommendations_collection.delete_many({
+        "$or": [{"updatedAt": {"$lt": started_at}}, {"updatedAt": {"$exists": False}}],
+        "staleAt": {"$exists": False}
+    })
+    _recommendation_model = model
+    print(f"Refreshed recommendations for {len(model.user_ids)} users over {len(model.items)} titles in {time.time() - start:.2f}s")
+    return model
+
+def refresh_all_recommendations(block_size: int = 256) -> RecommendationModel:
+    """Rebuild the model and precompute top-N for every user and every title."""
+    with _recommendation_lock:
+        return _refresh_all_recommendations(block_size)
+
+def get_recommendation_model() -> RecommendationModel:
+    """Return the current model, building it on first use."""
+    if _recommendation_model is None:
+        with _recommendation_lock:
+            # Another caller may have finished a build while we waited for the lock
+            if _recommendation_model is None:
+                _refresh_all_recommendations(256)
+    return _recommendation_model
+
+def refresh_user_recommendations(user_id: str) -> List[Dict[str, Any]]:
+    """Recompute a single user's top-N after their watch statuses change."""
+    get_recommendation_model()
+    entries = list(watch_status_collection.find(
+        {"userId": user_id, "status": {"$in": list(STATUS_WEIGHTS)}},
+        {"_id": 0, "contentId": 1, "contentType": 1, "status": 1}
+    ))
+    with _recommendation_lock:
+        # Pick up the model inside the lock in case a full refresh swapped it meanwhile
+        model = _recommendation_model
+        row = model.interaction_row(entries)
+        if not model.has_user(user_id) and not row.any():
+            return []
+        user_index = model.set_user(user_id, row)
+        results = _save_recommendations(model, np.array([user_index]))
+    return results.get(user_id, [])
+
+def refresh_stale_recommendations() -> int:
+    """Recompute every user whose watch statuses changed since their row was last written."""
+    stale = list(recommendations_collection.find(
+        {"staleAt": {"$exists": True}},
+        {"_id": 0, "userId": 1, "staleAt": 1}
+    ))
+    for entry in stale:
+        refresh_user_recommendations(entry['userId'])
+        # Only clear the flag if no newer status write happened while we were computing
+        recommendations_collection.update_one(
+            {"userId": entry['userId'], "staleAt": entry['staleAt']},
+            {"$unset": {"staleAt": ""}}
+        )
+    return len(stale)
+
+def mark_recommendations_stale(user_id: str) -> None:
+    """Flag a user's recommendations for the recommendations job to recompute."""
+    try:
+        recommendations_collection.update_one(
+            {"userId": user_id},
+            {"$set": {"staleAt": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+    except Exception as e:
+        print(f"Error flagging recommendations for user {user_id}: {str(e)}")
+
+@app.cli.command('recommendations')
+def recommendations_job():
+    """Keep the recommendation tables up to date.
+
+    Run a single instance next to the web workers: flask --app app recommendations
+    """
+    last_full_refresh = 0.0
+    while True:
+        try:
+            if time.time() - last_full_refresh >= RECOMMENDATIONS_REFRESH_SECONDS:
+                refresh_all_recommendations()
+                last_full_refresh = time.time()
+            else:
+                refresh_stale_recommendations()
+        except Exception as e:
+            print(f"Error refreshing recommendations: {str(e)}")
+        time.sleep(RECOMMENDATIONS_POLL_SECONDS)
+
+def _recommendations_limit() -> int:
+    limit = request.args.get('limit', 24, type=int)
+    return max(1, min(limit, RECOMMENDATIONS_TOP_N))
+
+@app.route('/users/<user_id>/recommendations', methods=['GET'])
+def get_user_recommendations(user_id):
+    """"For you" recommendations, served from the precomputed table."""
+    content_type = request.args.get('contentType')  # optional: 'movie', 'show' or 'anime'
+    limit = _recommendations_limit()
+
+    try:
+        cached = recommendations_collection.find_one({"userId": user_id}, {"_id": 0, "items": 1, "byType": 1}) or {}
+        if content_type:
+            # Each type keeps its own top-N so it isn't crowded out by the others
+            items = cached.get('byType', {}).get(content_type, [])
+        else:
+            items = cached.get('items', [])
+        items = [{**item, "posterUrl": poster_url(item.get('posterUrl'))} for item in items[:limit]]
+        return jsonify({"results": items})
+    except Exception as e:
+        print(f"Error fetching recommendations: {str(e)}")
+        return jsonify({"error": f"Error fetching recommendations: {str(e)}"}), 500
+
+@app.route('/api/recommendations/similar/<content_type>/<content_id>', methods=['GET'])
+def get_similar_content(content_type, content_id):
+    """"More like this" for a single title, served from the precomputed table."""
+    limit = _recommendations_limit()
+
+    try:
+        cached = similar_collection.find_one(
+            {"contentId": content_id, "contentType": content_type},
+            {"_id": 0, "items": 1}
+        )
+        items = cached.get('items', []) if cached else []
+        items = [{**item, "posterUrl": poster_url(item.get('posterUrl'))} for item in items[:limit]]
+        return jsonify({"results": items})
+    except Exception as e:
+        print(f"Error fetching similar content: {str(e)}")
+        return jsonify({"error": f"Error fetching similar content: {str(e)}"}), 500
+
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 5000))
     app.run(
@@ -0,0 +1,208 @@
+"""Content-addressed on-disk cache for poster images with pre-sized thumbnails.
+
+Kept free of MongoDB so the cache can be unit tested on its own.
+"""
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import requests
+from flask import redirect, send_file
+from PIL import Image
+from typing import Dict, Optional
+
+# Size of one urls/ index entry, which holds the hex digest of the poster it points to
+INDEX_ENTRY_BYTES = 64
+# Cached posters never change, so browsers can keep them for a year
+CACHE_MAX_AGE = 365 * 24 * 60 * 60
+# How long browsers should wait before asking again for a poster we couldn't cache
+FAILURE_MAX_AGE = 60 * 60
+
+class PosterCache:
+    """Posters stored by the hash of their content, each with a JPEG thumbnail per size.
+
+    Layout under cache_dir:
+        objects/<ab>/<digest>             the original image
+        objects/<ab>/<digest>-<size>.jpg  one thumbnail per size
+        objects/<ab>/<digest>.refs        hashes of the URLs that point at this image
+        urls/<cd>/<url hash>              the digest a URL resolved to
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int, sizes: Dict[str, int]):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # Thumbnail widths in pixels; height follows the poster's aspect ratio
+        self.sizes = sizes
+        self._lock = threading.Lock()
+        # Bytes this process believes are in the cache; None until the first scan
+        self._cache_bytes: Optional[int] = None
+
+    def object_path(self, digest: str, size: str) -> str:
+        return os.path.join(self.cache_dir, 'objects', digest[:2], f"{digest}-{size}.jpg" if size in self.sizes else digest)
+
+    def refs_path(self, digest: str) -> str:
+        return os.path.join(self.cache_dir, 'objects', digest[:2], f"{digest}.refs")
+
+    def index_path(self, url_hash: str) -> str:
+        return os.path.join(self.cache_dir, 'urls', url_hash[:2], url_hash)
+
+    def _has_thumbnails(self, digest: str) -> bool:
+        return all(os.path.exists(self.object_path(digest, size)) for size in self.sizes)
+
+    def cached_digest(self, source_url: str) -> Optional[str]:
+        """Content hash of a poster that is already on disk with all of its thumbnails."""
+        try:
+            with open(self.index_path(_url_hash(source_url))) as f:
+                digest = f.read().strip()
+        except OSError:
+            return None
+        return digest if self._has_thumbnails(digest) else None
+
+    def fetch(self, source_url: str) -> str:
+        """Download a poster and store it."""
+        response = requests.get(source_url, timeout=10)
+        response.raise_for_status()
+        if not response.headers.get('Content-Type', '').startswith('image/'):
+            raise ValueError(f"{source_url} is not an image")
+        return self.store(source_url, response.content)
+
+    def store(self, source_url: str, original: bytes) -> str:
+        """Store a poster by content hash with pre-sized thumbnails and return the hash."""
+        digest = hashlib.sha256(original).hexdigest()
+        written = 0
+        # Another URL may already have stored the same image
+        if not self._has_thumbnails(digest):
+            # Decode before writing anything so a broken image leaves nothing behind
+            thumbnails = _thumbnails(original, self.sizes)
+            _write_atomic(self.object_path(digest, 'original'), original)
+            written += len(original)
+            for size, data in thumbnails.items():
+                _write_atomic(self.object_path(digest, size), data)
+                written += len(data)
+
+        url_hash = _url_hash(source_url)
+        with open(self.refs_path(digest), 'a') as f:
+            f.write(f"{url_hash}\n")
+        _write_atomic(self.index_path(url_hash), digest.encode())
+        written += INDEX_ENTRY_BYTES + len(url_hash) + 1
+
+        self._track_bytes(written, keep=digest)
+        return digest
+
+    def _track_bytes(self, written: int, keep: str) -> None:
+        """Add newly written bytes to the running total and evict only once it goes over the limit."""
+        with self._lock:
+            if self._cache_bytes is None:
+                self._cache_bytes = self.evict(keep)
+                return
+            self._cache_bytes += written
+            if self._cache_bytes > self.max_bytes:
+                # Other workers write to the same directory, so the scan also corrects our total
+                self._cache_bytes = self.evict(keep)
+
+    def evict(self, keep: Optional[str] = None) -> int:
+        """Scan the cache, delete the least recently served posters if it is over the limit, and return its size.
+
+        Eviction goes down to 90% of max_bytes so the next scan isn't needed right away.
+        The poster in keep was just written and is never evicted.
+        """
+        objects_dir = os.path.join(self.cache_dir, 'objects')
+        # Group files by content hash so a poster, its thumbnails and its index entries go together
+        groups = {}
+        total = 0
+        for root, _, files in os.walk(objects_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                size = stat.st_size
+                if name.endswith('.refs'):
+                    # Each line is one index entry under urls/
+                    size += stat.st_size // 65 * INDEX_ENTRY_BYTES
+                group = groups.setdefault(name[:64], {"paths": [], "size": 0, "used": 0})
+                group["paths"].append(path)
+                group["size"] += size
+                group["used"] = max(group["used"], stat.st_mtime)
+                total += size
+
+        if total <= self.max_bytes:
+            return total
+        target = self.max_bytes * 0.9
+        for digest, group in sorted(groups.items(), key=lambda item: item[1]["used"]):
+            if digest == keep:
+                continue
+            try:
+                with open(self.refs_path(digest)) as f:
+                    url_hashes = f.read().split()
+            except OSError:
+                url_hashes = []
+            paths = [self.index_path(url_hash) for url_hash in url_hashes] + group["paths"]
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= group["size"]
+            print(f"Evicted poster {digest} from cache")
+            if total <= target:
+                break
+        return total
+
+    def response(self, source_url: str, size: str):
+        """Serve a thumbnail, fetching the poster first if needed, or redirect to the original."""
+        try:
+            digest = self.cached_digest(source_url) or self.fetch(source_url)
+            path = self.object_path(digest, size)
+            # Serving a poster marks it as recently used for eviction
+            os.utime(path)
+            response = send_file(
+                path,
+                mimetype='image/jpeg',
+                etag=f"{digest}-{size}",
+                max_age=CACHE_MAX_AGE,
+                conditional=True
+            )
+        except Exception as e:
+            # Let the browser load the original rather than showing a broken image,
+            # and keep it from asking us again for every render
+            print(f"Error caching poster {source_url}: {str(e)}")
+            response = redirect(source_url)
+            response.cache_control.max_age = FAILURE_MAX_AGE
+            response.cache_control.public = True
+            return response
+
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+def _url_hash(source_url: str) -> str:
+    return hashlib.sha256(source_url.encode()).hexdigest()
+
+def _thumbnails(original: bytes, sizes: Dict[str, int]) -> Dict[str, bytes]:
+    """JPEG thumbnails of an image, one per size."""
+    source_image = Image.open(io.BytesIO(original)).convert('RGB')
+    thumbnails = {}
+    for size, width in sizes.items():
+        image = source_image.copy()
+        # thumbnail() keeps the aspect ratio and never upscales
+        image.thumbnail((width, width * 3))
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=85, optimize=True, progressive=True)
+        thumbnails[size] = buffer.getvalue()
+    return thumbnails
+
+def _write_atomic(path: str, data: bytes) -> None:
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f"{os.path.basename(path)}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
@@ -0,0 +1,146 @@
+"""Genre and co-watch scoring for recommendations.
+
+Kept free of Flask and MongoDB so the matrix code can be unit tested on its own.
+"""
+import numpy as np
+from typing import List, Dict, Any
+
+# How strongly each watch status counts towards a user's taste
+STATUS_WEIGHTS = {
+    'rewatch': 1.5,
+    'watched': 1.0,
+    'currently_watching': 0.8,
+    'watch_later': 0.3
+}
+
+# Rows added to the interaction matrix at a time when new users show up
+USER_CHUNK_SIZE = 256
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Scale every row to unit length, leaving all-zero rows untouched."""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+def top_n(scores: np.ndarray, n: int) -> np.ndarray:
+    """Column indexes of the n best scores in each row, best first."""
+    n = min(n, scores.shape[1])
+    if n <= 0:
+        return np.zeros((scores.shape[0], 0), dtype=np.intp)
+    top = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+def build_genre_matrix(items: List[Dict[str, Any]]) -> np.ndarray:
+    """items x genres matrix with one unit-length row per title."""
+    genres = sorted({genre for item in items for genre in item.get('genres', []) if genre})
+    genre_index = {genre: i for i, genre in enumerate(genres)}
+
+    rows, cols = [], []
+    for i, item in enumerate(items):
+        for genre in item.get('genres', []):
+            if genre in genre_index:
+                rows.append(i)
+                cols.append(genre_index[genre])
+    genre_matrix = np.zeros((len(items), len(genres)), dtype=np.float32)
+    genre_matrix[rows, cols] = 1
+    return normalize_rows(genre_matrix)
+
+def _scale_rows_by_max(matrix: np.ndarray) -> np.ndarray:
+    max_values = matrix.max(axis=1, keepdims=True)
+    max_values[max_values == 0] = 1
+    return matrix / max_values
+
+class RecommendationModel:
+    """Genre and co-watch matrices for every catalog title and every user with a watch status."""
+
+    def __init__(self, items: List[Dict[str, Any]], genre_matrix: np.ndarray,
+                 user_ids: List[str], interactions: np.ndarray, genre_weight: float = 0.6):
+        self.items = items
+        self.item_index = {(item['type'], item['id']): i for i, item in enumerate(items)}
+        self.item_types = np.array([item['type'] for item in items])
+        # items x genres, one unit-length row per title
+        self.genre_matrix = genre_matrix
+        self.user_ids = list(user_ids)
+        self.user_index = {user_id: i for i, user_id in enumerate(self.user_ids)}
+        # users x items, weighted by STATUS_WEIGHTS; may have spare rows past len(user_ids)
+        self._interactions = interactions
+        # Share of the score that comes from genre similarity; the rest comes from co-watching
+        self.genre_weight = genre_weight
+
+    @property
+    def interactions(self) -> np.ndarray:
+        return self._interactions[:len(self.user_ids)]
+
+    def interaction_row(self, entries: List[Dict[str, Any]]) -> np.ndarray:
+        """Build a user's interaction vector from their watch status entries."""
+        row = np.zeros(len(self.items), dtype=np.float32)
+        for entry in entries:
+            index = self.item_index.get((entry['contentType'], entry['contentId']))
+            if index is not None:
+                row[index] = STATUS_WEIGHTS.get(entry['status'], 0)
+        return row
+
+    def has_user(self, user_id: str) -> bool:
+        return user_id in self.user_index
+
+    def set_user(self, user_id: str, row: np.ndarray) -> int:
+        """Insert or replace a user's interaction row and return its index."""
+        if user_id in self.user_index:
+            index = self.user_index[user_id]
+        else:
+            index = len(self.user_ids)
+            if index == self._interactions.shape[0]:
+                # Grow in chunks so adding users doesn't copy the whole matrix every time
+                spare = np.zeros((max(USER_CHUNK_SIZE, index), len(self.items)), dtype=np.float32)
+                self._interactions = np.vstack([self._interactions, spare])
+            self.user_ids.append(user_id)
+            self.user_index[user_id] = index
+        self._interactions[index] = row
+        return index
+
+    def score_users(self, user_indexes: np.ndarray) -> np.ndarray:
+        """Score every catalog title for a block of users in one pass."""
+        interactions = self.interactions
+        block = interactions[user_indexes]
+        # Genre similarity between each user's taste profile and each title
+        profiles = normalize_rows(block @ self.genre_matrix)
+        genre_scores = profiles @ self.genre_matrix.T
+        # Co-watch: titles watched by users who share titles with this user, weighted by overlap
+        overlap = block @ interactions.T
+        overlap[np.arange(len(user_indexes)), user_indexes] = 0
+        cowatch_scores = _scale_rows_by_max(overlap @ interactions)
+        scores = self.genre_weight * genre_scores + (1 - self.genre_weight) * cowatch_scores
+        # Never recommend something already in the user's library
+        scores[block > 0] = -np.inf
+        return scores
+
+    def score_similar(self, item_indexes: np.ndarray) -> np.ndarray:
+        """Score every catalog title against a block of titles in one pass."""
+        rows = np.arange(len(item_indexes))
+        genre_scores = self.genre_matrix[item_indexes] @ self.genre_matrix.T
+        # Co-watch: how many users have both titles in their library
+        watched = (self.interactions > 0).astype(np.float32)
+        cowatch = watched[:, item_indexes].T @ watched
+        cowatch[rows, item_indexes] = 0
+        cowatch_scores = _scale_rows_by_max(cowatch)
+        scores = self.genre_weight * genre_scores + (1 - self.genre_weight) * cowatch_scores
+        scores[rows, item_indexes] = -np.inf
+        return scores
+
+    def top_by_type(self, scores: np.ndarray, n: int) -> Dict[str, np.ndarray]:
+        """top_n for each content type separately, so one type can't crowd out the others."""
+        content_types, counts = np.unique(self.item_types, return_counts=True)
+        # Never ask for more titles than the type has, or other types would fill the gap
+        return {
+            content_type: top_n(np.where(self.item_types == content_type, scores, -np.inf), min(n, count))
+            for content_type, count in zip(content_types.tolist(), counts.tolist())
+        }
+
+    def cards(self, scores: np.ndarray, indexes: np.ndarray) -> List[Dict[str, Any]]:
+        """Turn ranked item indexes into cards, dropping titles with no signal."""
+        return [
+            {**self.items[i], "score": round(float(scores[i]), 4)}
+            for i in indexes
+            if scores[i] > 0
+        ]
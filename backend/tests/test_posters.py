@@ -0,0 +1,140 @@
+import io
+import os
+import random
+
+import pytest
+from flask import Flask, request
+from PIL import Image
+
+import posters
+from posters import PosterCache
+
+SIZES = {'small': 185, 'medium': 342}
+
+def make_image(seed):
+    # Random pixels so every poster is a different, poorly compressible image
+    rng = random.Random(seed)
+    buffer = io.BytesIO()
+    Image.frombytes('RGB', (200, 300), rng.randbytes(200 * 300 * 3)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def disk_usage(cache):
+    total = 0
+    for root, _, files in os.walk(cache.cache_dir):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+def age(cache, digest, mtime):
+    for root, _, files in os.walk(os.path.join(cache.cache_dir, 'objects')):
+        for name in files:
+            if name.startswith(digest):
+                os.utime(os.path.join(root, name), (mtime, mtime))
+
+def poster_bytes(tmp_path):
+    """Size of one stored poster as the cache accounts for it."""
+    cache = PosterCache(str(tmp_path / 'probe'), 10 ** 9, SIZES)
+    cache.store('https://image.tmdb.org/probe.jpg', make_image(0))
+    return cache.evict()
+
+def test_store_writes_original_thumbnails_and_index(tmp_path):
+    cache = PosterCache(str(tmp_path), 10 ** 9, SIZES)
+    digest = cache.store('https://image.tmdb.org/a.jpg', make_image(1))
+    assert cache.cached_digest('https://image.tmdb.org/a.jpg') == digest
+    assert os.path.exists(cache.object_path(digest, 'original'))
+    medium = Image.open(cache.object_path(digest, 'medium'))
+    assert medium.size == (200, 300)  # never upscaled
+    assert Image.open(cache.object_path(digest, 'small')).size == (185, 278)
+
+def test_running_total_matches_scan(tmp_path):
+    cache = PosterCache(str(tmp_path), 10 ** 9, SIZES)
+    for i in range(3):
+        cache.store(f'https://image.tmdb.org/{i}.jpg', make_image(i))
+    assert cache._cache_bytes == cache.evict()
+    # Index entries hold exactly one hex digest, so the accounting matches what is on disk
+    assert cache._cache_bytes == disk_usage(cache)
+
+def test_eviction_stays_under_limit_and_drops_index_entries(tmp_path):
+    max_bytes = int(poster_bytes(tmp_path) * 3.5)
+    cache = PosterCache(str(tmp_path / 'cache'), max_bytes, SIZES)
+    digests = []
+    for i in range(6):
+        url = f'https://image.tmdb.org/{i}.jpg'
+        digests.append(cache.store(url, make_image(i)))
+        # Make serve order explicit instead of relying on timestamp resolution
+        age(cache, digests[-1], 1000 + i)
+        assert disk_usage(cache) <= max_bytes
+
+    assert cache.cached_digest('https://image.tmdb.org/0.jpg') is None
+    url_hash = posters._url_hash('https://image.tmdb.org/0.jpg')
+    assert not os.path.exists(cache.index_path(url_hash))
+    assert not os.path.exists(cache.object_path(digests[0], 'original'))
+    assert cache.cached_digest('https://image.tmdb.org/5.jpg') == digests[5]
+
+def test_eviction_goes_down_to_ninety_percent(tmp_path):
+    per_poster = poster_bytes(tmp_path)
+    cache = PosterCache(str(tmp_path / 'cache'), 10 ** 9, SIZES)
+    for i in range(5):
+        age(cache, cache.store(f'https://image.tmdb.org/{i}.jpg', make_image(i)), 1000 + i)
+    cache.max_bytes = int(per_poster * 4.5)
+    assert cache.evict() <= cache.max_bytes * 0.9
+
+def test_eviction_never_removes_poster_just_written(tmp_path):
+    cache = PosterCache(str(tmp_path), 1, SIZES)
+    first = cache.store('https://image.tmdb.org/a.jpg', make_image(1))
+    assert cache.cached_digest('https://image.tmdb.org/a.jpg') == first
+    second = cache.store('https://image.tmdb.org/b.jpg', make_image(2))
+    assert cache.cached_digest('https://image.tmdb.org/b.jpg') == second
+    assert cache.cached_digest('https://image.tmdb.org/a.jpg') is None
+
+def test_undecodable_image_leaves_nothing_behind(tmp_path):
+    cache = PosterCache(str(tmp_path), 10 ** 9, SIZES)
+    with pytest.raises(Exception):
+        cache.store('https://image.tmdb.org/broken.jpg', b'not an image')
+    assert disk_usage(cache) == 0
+
+class FakeResponse:
+    def __init__(self, content, content_type='image/png'):
+        self.content = content
+        self.headers = {'Content-Type': content_type}
+
+    def raise_for_status(self):
+        pass
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    cache = PosterCache(str(tmp_path), 10 ** 9, SIZES)
+    fetched = []
+
+    def fake_get(url, timeout):
+        fetched.append(url)
+        if 'missing' in url:
+            return FakeResponse(b'<html>', 'text/html')
+        return FakeResponse(make_image(1))
+
+    monkeypatch.setattr(posters.requests, 'get', fake_get)
+    app = Flask(__name__)
+
+    @app.route('/posters/<size>')
+    def poster(size):
+        return cache.response(request.args['url'], size)
+
+    return app.test_client(), fetched
+
+def test_response_is_cached_and_honours_etag(client):
+    client, fetched = client
+    url = '/posters/medium?url=https://image.tmdb.org/a.jpg'
+    first = client.get(url)
+    assert first.status_code == 200
+    assert first.mimetype == 'image/jpeg'
+    assert 'immutable' in first.headers['Cache-Control']
+    second = client.get(url, headers={'If-None-Match': first.headers['ETag']})
+    assert second.status_code == 304
+    assert len(fetched) == 1
+
+def test_failed_fetch_redirects_with_short_cache(client):
+    client, fetched = client
+    response = client.get('/posters/medium?url=https://image.tmdb.org/missing.jpg')
+    assert response.status_code == 302
+    assert response.headers['Location'] == 'https://image.tmdb.org/missing.jpg'
+    assert response.cache_control.max_age == posters.FAILURE_MAX_AGE
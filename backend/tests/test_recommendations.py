@@ -0,0 +1,76 @@
+import numpy as np
+
+from recommendations import USER_CHUNK_SIZE, RecommendationModel, build_genre_matrix, top_n
+
+def make_model(interactions):
+    items = [
+        {"id": "0", "type": "movie", "genres": ["Action"]},
+        {"id": "1", "type": "movie", "genres": ["Action", "Comedy"]},
+        {"id": "2", "type": "movie", "genres": ["Comedy"]},
+        {"id": "3", "type": "movie", "genres": ["Drama"]},
+        {"id": "4", "type": "movie", "genres": ["Action", "Drama"]},
+    ]
+    interactions = np.array(interactions, dtype=np.float32)
+    user_ids = [f"user{i}" for i in range(len(interactions))]
+    return RecommendationModel(items, build_genre_matrix(items), user_ids, interactions)
+
+def test_top_n_orders_best_first():
+    scores = np.array([[0.1, 0.9, -np.inf, 0.5], [0.3, 0.2, 0.8, 0.0]])
+    assert top_n(scores, 2).tolist() == [[1, 3], [2, 0]]
+
+def test_top_n_handles_small_and_empty_requests():
+    scores = np.array([[0.1, 0.9]])
+    assert top_n(scores, 5).tolist() == [[1, 0]]
+    assert top_n(scores, 0).shape == (1, 0)
+
+def test_score_users_excludes_library():
+    model = make_model([[1, 0, 0, 0, 0], [1, 0, 0, 1, 0]])
+    scores = model.score_users(np.array([0, 1]))
+    assert scores[0, 0] == -np.inf
+    assert np.isneginf(scores[1, [0, 3]]).all()
+    top = top_n(scores, 5)
+    assert [card["id"] for card in model.cards(scores[0], top[0])] == ["1", "4", "3"]
+    assert [card["id"] for card in model.cards(scores[1], top[1])] == ["4", "1"]
+
+def test_score_users_ignores_own_overlap():
+    # A lone user has no one to co-watch with, so only genre similarity counts
+    model = make_model([[1, 0, 0, 0, 0]])
+    scores = model.score_users(np.array([0]))
+    assert scores[0, 3] == 0
+    assert np.isclose(scores[0, 1], model.genre_weight * np.sqrt(0.5))
+
+def test_score_similar_excludes_title_and_uses_cowatch():
+    model = make_model([[1, 0, 0, 1, 0], [1, 0, 0, 1, 0], [0, 1, 0, 0, 0]])
+    scores = model.score_similar(np.array([0, 3]))
+    assert scores[0, 0] == -np.inf
+    assert scores[1, 3] == -np.inf
+    # Drama shares no genre with Action but every user who watched one watched the other
+    assert np.isclose(scores[0, 3], 1 - model.genre_weight)
+    top = top_n(scores, 3)[0]
+    assert set(top[:2]) == {1, 4}
+    assert top[2] == 3
+
+def test_set_user_grows_in_chunks():
+    model = make_model([[1, 0, 0, 0, 0]])
+    index = model.set_user("new", np.array([0, 0, 1, 0, 0], dtype=np.float32))
+    assert index == 1
+    assert model.interactions.shape == (2, 5)
+    assert model._interactions.shape[0] == 1 + USER_CHUNK_SIZE
+    buffer = model._interactions
+    model.set_user("another", np.zeros(5, dtype=np.float32))
+    assert model._interactions is buffer
+    assert model.set_user("new", np.ones(5, dtype=np.float32)) == 1
+    assert model.interactions[1].tolist() == [1, 1, 1, 1, 1]
+
+def test_top_by_type_ranks_each_type_separately():
+    items = [
+        {"id": "0", "type": "anime", "genres": ["Action"]},
+        {"id": "1", "type": "anime", "genres": ["Action"]},
+        {"id": "2", "type": "movie", "genres": ["Action", "Drama"]},
+        {"id": "3", "type": "anime", "genres": ["Drama"]},
+    ]
+    model = RecommendationModel(items, build_genre_matrix(items), ["user0"], np.zeros((1, 4), dtype=np.float32))
+    scores = np.array([[0.9, 0.8, 0.1, 0.7]])
+    by_type = model.top_by_type(scores, 2)
+    assert by_type["anime"].tolist() == [[0, 1]]
+    assert [card["id"] for card in model.cards(scores[0], by_type["movie"][0])] == ["2"]